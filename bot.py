@@ -13,7 +13,10 @@ Changes in this version:
 
 import asyncio
 import logging
+from functools import lru_cache, partial
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence
 
+import orjson
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.types import Message, ContentType
@@ -24,24 +27,43 @@ from aiogram.client.session.aiohttp import AiohttpSession
 from config import BOT_TOKEN, ADMIN_IDS
 from storage import (
     init_db,
+    close_db,
     upsert_channel,
     list_channels,
     add_mapping,
     remove_mapping,
+    is_mirrored_source,
     list_mappings_for_source,
     add_link_rule,
     remove_link_rule,
     list_link_rules,
+    get_compiled_rules,
 )
-from link_rules import replace_links_in_html
+from link_rules import CompiledRules, replace_links_in_html
 
 # ---------- Logging ----------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("mirror-bot")
 
 # ---------- Aiogram objects ----------
+def _orjson_dumps(obj: Any) -> str:
+    # aiogram puts the dumped value into form fields, so it needs str, not bytes
+    return orjson.dumps(obj).decode()
+
+
+class MirrorSession(AiohttpSession):
+    """AiohttpSession with orjson (de)serialization and longer-lived keep-alive connections."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("json_loads", orjson.loads)
+        kwargs.setdefault("json_dumps", _orjson_dumps)
+        super().__init__(**kwargs)
+        # keep idle connections alive between posts instead of aiohttp's 15 s default
+        self._connector_init.update(keepalive_timeout=75)
+
+
 # More robust HTTP client timeouts for unstable networks
-session = AiohttpSession(timeout=60)
+session = MirrorSession(timeout=60)
 
 bot = Bot(
     BOT_TOKEN,
@@ -51,10 +73,6 @@ bot = Bot(
 dp = Dispatcher()
 
 
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
-
-
 # ---------- Common commands (private chat) ----------
 @dp.message(Command("start"))
 async def start(m: Message):
@@ -77,7 +95,7 @@ async def help_cmd(m: Message):
     await m.answer(txt)
 
 async def ensure_admin(m: Message) -> bool:
-    if not is_admin(m.from_user.id):
+    if m.from_user.id not in ADMIN_IDS:
         await m.answer("Тільки для адмінів.")
         return False
     return True
@@ -192,125 +210,192 @@ async def add_dest_from_channel(m: Message):
 
 
 # ---------- Mirroring helpers ----------
-async def get_rules():
-    rows = await list_link_rules()
-    return [(r[1], r[2], r[3]) for r in rows]  # (pattern, url_repl, text_repl)
+# process-wide cap on in-flight sends, shared by every post and edit;
+# limits concurrency only, not the rate (Telegram allows ~30 msg/s per bot)
+_send_sem = asyncio.Semaphore(16)
 
-async def mirror_to_dests(source_chat_id: int, send_fn):
-    dest_ids = await list_mappings_for_source(source_chat_id)
-    for dest in dest_ids:
+async def _safe_send(send_fn, dest: int):
+    async with _send_sem:
         try:
             await send_fn(dest)
         except Exception as e:
             logger.warning("Send to %s failed: %s", dest, e)
 
-def transform_html_with_rules(html_text: str, rules):
-    return replace_links_in_html(html_text or "", rules)
+async def mirror_to_dests(dest_ids: Sequence[int], send_fn):
+    if len(dest_ids) == 1:
+        # the usual one-to-one mirror: no gather/task overhead
+        await _safe_send(send_fn, dest_ids[0])
+        return
+    # all destinations in flight at once over the shared aiohttp session
+    await asyncio.gather(*(_safe_send(send_fn, dest) for dest in dest_ids))
+
+# one lru_cache per rule-set version, keyed by the text alone: a lookup hashes one str
+# instead of every compiled pattern, and a new rule set simply replaces the whole cache
+_transform_version: Optional[int] = None
+_transform_cached: Callable[[str], str] = str
+
+def transform_html_with_rules(html_text: str, rules: CompiledRules) -> str:
+    global _transform_version, _transform_cached
+    if not html_text:
+        return ""
+    # same checks replace_links_in_html gates on: posts without links skip the cache
+    if "http" not in html_text and "href=" not in html_text.lower():
+        return html_text
+    if rules.version != _transform_version:
+        # repeated texts (shared footers, reposts) are rewritten once per rule set
+        _transform_cached = lru_cache(maxsize=1024)(partial(replace_links_in_html, rules=rules))
+        _transform_version = rules.version
+    return _transform_cached(html_text)
+
+
+# ---------- Per-content-type senders ----------
+# each factory builds the send(dest_id) coroutine for one post;
+# html is the post's text or caption, already rendered and transformed
+SendFn = Callable[[int], Awaitable[None]]
+
+def _text_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_message(dest_id, html)
+    return send
+
+def _photo_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_photo(dest_id, m.photo[-1].file_id, caption=html)
+    return send
+
+def _video_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_video(dest_id, m.video.file_id, caption=html)
+    return send
+
+def _animation_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_animation(dest_id, m.animation.file_id, caption=html)
+    return send
+
+def _document_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_document(dest_id, m.document.file_id, caption=html)
+    return send
+
+def _audio_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_audio(dest_id, m.audio.file_id, caption=html)
+    return send
+
+def _voice_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_voice(dest_id, m.voice.file_id, caption=html)
+    return send
+
+def _video_note_sender(m: Message, html: str) -> SendFn:
+    async def send(dest_id: int):
+        await bot.send_video_note(dest_id, m.video_note.file_id)
+    return send
+
+def _poll_sender(m: Message, html: str) -> SendFn:
+    if not m.poll:
+        return _copy_sender(m, html)
+    # built once per post, shared by every destination
+    poll = m.poll
+    options = [o.text for o in poll.options]
+    is_quiz = poll.type == "quiz"
+    correct_option_id = poll.correct_option_id if is_quiz else None
+    explanation = poll.explanation if is_quiz else None
+    async def send(dest_id: int):
+        await bot.send_poll(
+            chat_id=dest_id,
+            question=poll.question,
+            options=options,
+            is_anonymous=poll.is_anonymous,
+            allows_multiple_answers=poll.allows_multiple_answers,
+            type=poll.type,
+            correct_option_id=correct_option_id,
+            explanation=explanation,
+        )
+    return send
+
+def _copy_sender(m: Message, html: str) -> SendFn:
+    # fallback copy when content type not handled explicitly
+    async def send(dest_id: int):
+        await bot.copy_message(chat_id=dest_id, from_chat_id=m.chat.id, message_id=m.message_id)
+    return send
+
+HANDLERS: Dict[ContentType, Callable[[Message, str], SendFn]] = {
+    ContentType.TEXT: _text_sender,
+    ContentType.PHOTO: _photo_sender,
+    ContentType.VIDEO: _video_sender,
+    ContentType.ANIMATION: _animation_sender,
+    ContentType.DOCUMENT: _document_sender,
+    ContentType.AUDIO: _audio_sender,
+    ContentType.VOICE: _voice_sender,
+    ContentType.VIDEO_NOTE: _video_note_sender,
+    ContentType.POLL: _poll_sender,
+}
+
+# senders that put the post's text/caption on the wire; VIDEO_NOTE, POLL and the
+# copy fallback never read html, so for them it is not rendered or rewritten at all
+_HTML_TYPES = frozenset({
+    ContentType.TEXT,
+    ContentType.PHOTO,
+    ContentType.VIDEO,
+    ContentType.ANIMATION,
+    ContentType.DOCUMENT,
+    ContentType.AUDIO,
+    ContentType.VOICE,
+})
+
+
+async def _dispatch(m: Message, dest_ids: Sequence[int], rules: CompiledRules, prefix_html: str = ""):
+    html = ""
+    if m.content_type in _HTML_TYPES:
+        # html_text renders text or caption entities in Python, so do it exactly once per post
+        html = prefix_html + transform_html_with_rules(m.html_text, rules)
+    send = HANDLERS.get(m.content_type, _copy_sender)(m, html)
+    await mirror_to_dests(dest_ids, send)
 
 
 # ---------- New channel posts ----------
 @dp.channel_post()
 async def on_channel_post(m: Message):
+    # most channels the bot sits in are not sources — bail out before any await
+    if not is_mirrored_source(m.chat.id):
+        return
     dest_ids = await list_mappings_for_source(m.chat.id)
     if not dest_ids:
         return
 
-    rules = await get_rules()
-
-    if m.content_type == ContentType.TEXT:
-        html = transform_html_with_rules(m.html_text, rules)
-        async def send(dest_id: int):
-            await bot.send_message(dest_id, html, disable_web_page_preview=False)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.PHOTO:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_photo(dest_id, m.photo[-1].file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.VIDEO:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_video(dest_id, m.video.file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.ANIMATION:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_animation(dest_id, m.animation.file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.DOCUMENT:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_document(dest_id, m.document.file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.AUDIO:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_audio(dest_id, m.audio.file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.VOICE:
-        html = transform_html_with_rules(m.caption_html or "", rules)
-        async def send(dest_id: int):
-            await bot.send_voice(dest_id, m.voice.file_id, caption=html)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.VIDEO_NOTE:
-        async def send(dest_id: int):
-            await bot.send_video_note(dest_id, m.video_note.file_id)
-        await mirror_to_dests(m.chat.id, send)
-
-    elif m.content_type == ContentType.POLL and m.poll:
-        async def send(dest_id: int):
-            await bot.send_poll(
-                chat_id=dest_id,
-                question=m.poll.question,
-                options=[o.text for o in m.poll.options],
-                is_anonymous=m.poll.is_anonymous,
-                allows_multiple_answers=m.poll.allows_multiple_answers,
-                type=m.poll.type,
-                correct_option_id=m.poll.correct_option_id if m.poll.type == "quiz" else None,
-                explanation=m.poll.explanation if m.poll.type == "quiz" else None,
-            )
-        await mirror_to_dests(m.chat.id, send)
-
-    else:
-        # fallback copy when content type not handled explicitly
-        async def send(dest_id: int):
-            await bot.copy_message(chat_id=dest_id, from_chat_id=m.chat.id, message_id=m.message_id)
-        await mirror_to_dests(m.chat.id, send)
+    await _dispatch(m, dest_ids, await get_compiled_rules())
 
 
 # ---------- Edited posts (MVP: repost with "updated") ----------
 @dp.edited_channel_post()
 async def on_edited_channel_post(m: Message):
+    if not is_mirrored_source(m.chat.id):
+        return
     dest_ids = await list_mappings_for_source(m.chat.id)
     if not dest_ids:
         return
 
-    rules = await get_rules()
-    def transform(html_text: str) -> str:
-        return transform_html_with_rules(html_text or "", rules)
-
-    if m.content_type == ContentType.TEXT:
-        html = transform(m.html_text)
-        async def send(dest_id: int):
-            await bot.send_message(dest_id, f"🔁 <i>Оновлено</i>\n\n{html}")
-        await mirror_to_dests(m.chat.id, send)
-    else:
-        await on_channel_post(m)
+    # only text edits get the marker; media edits are reposted as-is
+    prefix_html = "🔁 <i>Оновлено</i>\n\n" if m.content_type == ContentType.TEXT else ""
+    await _dispatch(m, dest_ids, await get_compiled_rules(), prefix_html)
 
 
 # ---------- Entrypoint ----------
 async def main():
     await init_db()
     logger.info("Bot started.")
-    # shorter polling timeout helps behind strict proxies/NATs
-    await dp.start_polling(bot, polling_timeout=25)
+    try:
+        # long polling near Telegram's 50 s maximum: fewer getUpdates round trips.
+        # aiogram adds session.timeout (60 s) on top, so the HTTP read never
+        # expires before the server answers.
+        # allowed_updates is left unset on purpose: aiogram then sends only the
+        # update types that have handlers (dp.resolve_used_update_types()).
+        await dp.start_polling(bot, polling_timeout=50)
+    finally:
+        # the shared DB connection runs on its own (non-daemon) thread
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
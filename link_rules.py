@@ -1,45 +1,115 @@
 import re
-from typing import List, Tuple, Optional
+from functools import lru_cache
+from typing import List, NamedTuple, Tuple, Optional, Pattern
 
 # Патерн якірів <a href="...">текст</a>
+# Без DOTALL і `.*?`: атрибути — до першого `>`, текст — до `</a>` або наступного `<a `
+# (вкладені <b>/<i> лишаються), тож незакриті <a> не дають квадратичного перебору.
 A_TAG_RE = re.compile(
-    r'(<a\s+[^>]*?href=")([^"]+)(".*?>)(.*?)(</a>)',
-    re.IGNORECASE | re.DOTALL
+    r'(<a\s+[^>]*?href=")([^"]+)("[^>]*>)([^<]*(?:<(?!/a>|a\s)[^<]*)*)(</a>)',
+    re.IGNORECASE
 )
 
-# rules: list of (pattern, new_url, new_text_or_None)
-def replace_links_in_html(html: str, rules: List[Tuple[str, str, Optional[str]]]) -> str:
-    if not html or not rules:
+# «Голі» URL у тексті
+_RAW_URL_RE = re.compile(r'https?://[^\s<"]+')
+
+# Нумеровані зворотні посилання / умовні групи зсуваються при об'єднанні патернів
+_GROUP_REF_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+@lru_cache(maxsize=256)
+def _compile(pat: str) -> Optional[Pattern]:
+    # некоректний regex кешуємо як None, щоб не падати на ньому щоразу
+    try:
+        return re.compile(pat, re.IGNORECASE)
+    except re.error:
+        return None
+
+
+CompiledRule = Tuple[Pattern, str, Optional[str]]
+
+
+class CompiledRules(NamedTuple):
+    rules: Tuple[CompiledRule, ...]
+    # усі патерни однією альтернацією (?P<r0>...)|(?P<r1>...) — швидка перевірка,
+    # чи URL взагалі зачіпає хоч одне правило; None, якщо об'єднати не можна
+    combined: Optional[Pattern]
+    # номер версії набору правил — дешевий ключ кешу замість хешування всіх патернів
+    version: int = 0
+
+
+def _combine(rules: Tuple[CompiledRule, ...]) -> Optional[Pattern]:
+    if len(rules) < 2:
+        return None
+    if any(_GROUP_REF_RE.search(pat.pattern) for pat, _, _ in rules):
+        return None
+    try:
+        return re.compile(
+            "|".join(f"(?P<r{i}>{pat.pattern})" for i, (pat, _, _) in enumerate(rules)),
+            re.IGNORECASE,
+        )
+    except re.error:
+        # конфлікт іменованих груп, глобальні прапорці посеред патерна тощо
+        return None
+
+
+# rules: list of (pattern, new_url, new_text_or_None) -> ті самі правила зі скомпільованими патернами
+def compile_rules(rules: List[Tuple[str, str, Optional[str]]], version: int = 0) -> CompiledRules:
+    compiled_rules = []
+    for pat, url_repl, text_repl in rules:
+        compiled = _compile(pat)
+        if compiled is None:
+            # некоректний regex — ігноруємо
+            continue
+        compiled_rules.append((compiled, url_repl, text_repl))
+    compiled_rules = tuple(compiled_rules)
+    return CompiledRules(compiled_rules, _combine(compiled_rules), version)
+
+
+# rules: результат compile_rules()
+def replace_links_in_html(html: str, rules: CompiledRules) -> str:
+    if not html or not rules.rules:
         return html or ""
+    combined = rules.combined
 
     def replace_a_tag(m: re.Match) -> str:
         prefix, href, mid, text, suffix = m.groups()
+        if combined is not None and not combined.search(href):
+            # жодне правило не зачіпає цей href — один прохід замість N
+            return m.group(0)
         new_href = href
         new_text = text
-        for pat, url_repl, text_repl in rules:
+        for pat, url_repl, text_repl in rules.rules:
             try:
-                if re.search(pat, href, flags=re.IGNORECASE):
-                    new_href = re.sub(pat, url_repl, href, flags=re.IGNORECASE)
+                if pat.search(href):
+                    new_href = pat.sub(url_repl, href)
                     if text_repl is not None:
                         new_text = text_repl
             except re.error:
-                # некоректний regex — ігноруємо
+                # некоректна заміна (напр. неіснуюча група) — ігноруємо
                 pass
         return f"{prefix}{new_href}{mid}{new_text}{suffix}"
 
     # 1) Замінюємо у <a href="...">...</a>
-    html = A_TAG_RE.sub(replace_a_tag, html)
+    # дешева перевірка підрядка замість regex-проходу (A_TAG_RE нечутливий до регістру)
+    if "href=" in html.lower():
+        html = A_TAG_RE.sub(replace_a_tag, html)
 
     # 2) Замінюємо «голі» URL у тексті (поза тегами) — лише URL, текст залишаємо як є
     def repl_raw(m: re.Match) -> str:
         orig = m.group(0)
+        if combined is not None and not combined.search(orig):
+            return orig
         new_val = orig
-        for pat, rep, _ in rules:
+        for pat, rep, _ in rules.rules:
             try:
-                new_val = re.sub(pat, rep, new_val, flags=re.IGNORECASE)
+                new_val = pat.sub(rep, new_val)
             except re.error:
                 pass
         return new_val
 
-    html = re.sub(r'(https?://[^\s<]+)', repl_raw, html)
+    if "http" not in html:
+        # більшість постів без посилань — пропускаємо regex повністю
+        return html
+    html = _RAW_URL_RE.sub(repl_raw, html)
     return html
@@ -1,98 +1,356 @@
-import aiosqlite
-from typing import List, Tuple, Optional
+import asyncio
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple, Optional
+
+from link_rules import CompiledRules, compile_rules
 
 import os
 DB_PATH = os.getenv("MIRROR_DB_PATH", "mirror.db")  # підтримка персистентного диска
 
+# Рядки, які повертають list_*: кортежі (розпаковуються як раніше), але з іменами полів
+class Channel(NamedTuple):
+    id: int
+    tg_id: int
+    title: str
+    kind: str
+
+
+class LinkRule(NamedTuple):
+    id: int
+    pattern: str
+    replacement: str
+    text_repl: Optional[str]
+
+
+# Одне з'єднання на весь процес. Гарячі читання (mappings, правила) йдуть з кешів
+# у пам'яті, тож БД потрібна лише адмінським командам — тому _db звичайне sqlite3:
+# пачка записів чи list_channels виконуються одним asyncio.to_thread.
+# Відкривається в init_db (або першим get_db), закривається в close_db
+_db: Optional[sqlite3.Connection] = None
+_db_lock = asyncio.Lock()  # щоб два виклики не відкрили з'єднання двічі
+_closed = False  # встановлює close_db: після нього get_db/_write не відкривають БД самі
+_conn_lock = threading.Lock()  # _db використовується з потоків пулу to_thread
+
+# Черга записів: (op, future), де op(db) — синхронна функція з SQL операціями. Один
+# фоновий _writer забирає все, що накопичилось, і виконує однією транзакцією —
+# один commit/fsync на пачку.
+WriteOp = Callable[[sqlite3.Connection], Any]
+_WRITE_QUEUE_SIZE = 1024  # при переповненні _write чекає — зворотний тиск замість росту пам'яті
+_WRITE_BATCH_MAX = 256    # обмежує час, на який одна транзакція тримає блокування запису
+_write_q: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+# Кеш у пам'яті для того, що читається на кожен пост: заповнюється в init_db,
+# оновлюється разом із SQL у функціях запису. Значення незмінні (кортежі) або
+# замінюються новим списком — повернуті раніше значення лишаються валідними.
+_mappings: Dict[int, Tuple[int, ...]] = {}  # source_tg_id -> (dest_tg_id, ...)
+_link_rules: List[LinkRule] = []
+# скомпільовані _link_rules; скидається в None при кожній зміні правил
+_compiled_rules: Optional[CompiledRules] = None
+# зростає при кожній зміні правил (і не скидається в close_db) — CompiledRules.version
+_rules_version = 0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tg_id INTEGER UNIQUE NOT NULL,
+    title TEXT,
+    kind TEXT CHECK(kind IN ('source','destination')) NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mappings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source_tg_id INTEGER NOT NULL,
+    dest_tg_id INTEGER NOT NULL,
+    UNIQUE(source_tg_id, dest_tg_id)
+);
+CREATE TABLE IF NOT EXISTS link_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pattern TEXT NOT NULL,
+    replacement TEXT NOT NULL
+);
+-- list_channels(kind) фільтрує за kind; mappings за source_tg_id покриває
+-- індекс UNIQUE(source_tg_id, dest_tg_id) (source_tg_id — перша колонка).
+-- id — це rowid, тож записи індексу вже впорядковані як (kind, id):
+-- ORDER BY id DESC читає його у зворотному порядку без окремого сортування
+CREATE INDEX IF NOT EXISTS idx_channels_kind ON channels(kind);
+"""
+
+# журнал WAL зберігається у файлі БД, решта PRAGMA діє лише на з'єднання.
+# WAL: читачі не блокуються записом; NORMAL: без fsync на кожен commit
+_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",  # ~64 МБ сторінкового кешу
+    # читання через mmap замість pread; SQLite обмежує розмір файлом БД
+    "PRAGMA mmap_size=268435456",
+)
+
+def _open_db() -> Tuple[sqlite3.Connection, Dict[int, Tuple[int, ...]], List[LinkRule]]:
+    # синхронно, в потоці: з'єднання, схема/міграції та початкові дані кешів.
+    # isolation_level=None — транзакціями керуємо явно (BEGIN у _apply_batch)
+    db = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    # page_size діє лише на ще порожній файл і має йти до журналу WAL,
+    # тож існуючі БД не чіпаємо (для них знадобився б VACUUM)
+    ((tables,),) = db.execute("SELECT count(*) FROM sqlite_master").fetchall()
+    if tables == 0:
+        db.execute("PRAGMA page_size=8192")
+    db.execute("PRAGMA journal_mode=WAL")
+    for pragma in _PRAGMAS:
+        db.execute(pragma)
+    # міграції за PRAGMA user_version: на вже оновленій БД — жодних зайвих запитів
+    ((version,),) = db.execute("PRAGMA user_version").fetchall()
+    script = _SCHEMA
+    if version < 1:
+        # v1: колонка text_repl. Старі БД могли отримати її ще до user_version,
+        # а на новій таблиці ще немає — тоді колонка додасться одразу після CREATE
+        columns = {r[1] for r in db.execute("PRAGMA table_info(link_rules)")}
+        if "text_repl" not in columns:
+            script += "ALTER TABLE link_rules ADD COLUMN text_repl TEXT DEFAULT NULL;\n"
+        script += "PRAGMA user_version=1;\n"
+    # уся схема й міграції одним викликом і однією транзакцією
+    db.executescript(f"BEGIN;\n{script}COMMIT;")
+
+    mappings: Dict[int, List[int]] = {}
+    for src, dst in db.execute("SELECT source_tg_id, dest_tg_id FROM mappings ORDER BY id ASC"):
+        mappings.setdefault(src, []).append(dst)
+
+    link_rules = [LinkRule._make(r) for r in db.execute(
+        "SELECT id, pattern, replacement, text_repl FROM link_rules ORDER BY id ASC"
+    )]
+    return db, {src: tuple(dests) for src, dests in mappings.items()}, link_rules
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS channels (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tg_id INTEGER UNIQUE NOT NULL,
-            title TEXT,
-            kind TEXT CHECK(kind IN ('source','destination')) NOT NULL
-        )""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS mappings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_tg_id INTEGER NOT NULL,
-            dest_tg_id INTEGER NOT NULL,
-            UNIQUE(source_tg_id, dest_tg_id)
-        )""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS link_rules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pattern TEXT NOT NULL,
-            replacement TEXT NOT NULL
-        )""")
-        # міграція: додаємо колонку text_repl, якщо її ще нема
+    global _db, _mappings, _link_rules, _compiled_rules, _rules_version
+    global _write_q, _writer_task, _closed
+    async with _db_lock:
+        _closed = False  # явний init_db після close_db відкриває БД знову
+        if _db is not None:
+            return  # вже ініціалізовано (напр. повторний /start)
+        db, mappings, link_rules = await asyncio.to_thread(_open_db)
+
+        # усе разом і без await між присвоєннями: get_db() бачить лише повністю
+        # налаштоване з'єднання й кеші
+        _mappings, _link_rules = mappings, link_rules
+        _compiled_rules = None
+        _rules_version += 1
+        _write_q = asyncio.Queue(_WRITE_QUEUE_SIZE)
+        _writer_task = asyncio.create_task(_writer(db, _write_q))
+        _db = db
+
+def _check_open():
+    if _closed:
+        raise RuntimeError("Сховище закрито (close_db); відкрити знову можна лише явним init_db()")
+
+async def get_db() -> sqlite3.Connection:
+    _check_open()
+    if _db is None:
+        await init_db()
+    return _db
+
+# Обов'язково викликати (await) при завершенні роботи: дописує чергу записів
+# і закриває з'єднання. Після close_db записи й читання з БД падають з
+# RuntimeError, а не відкривають з'єднання й писаря заново.
+async def close_db():
+    global _db, _write_q, _writer_task, _closed
+    async with _db_lock:
+        # спершу, до будь-якого await: нові _write вже не потраплять у чергу
+        _closed = True
+        await flush()  # дописуємо все, що вже в черзі
+        # глобальні знімаємо разом, без await між присвоєннями
+        db, task = _db, _writer_task
+        _db = _write_q = _writer_task = None
+        if task is not None:
+            task.cancel()
+        if db is not None:
+            with _conn_lock:
+                db.close()
+
+def _apply_batch(db: sqlite3.Connection, ops: List[WriteOp]) -> List[Tuple[Any, Optional[Exception]]]:
+    # синхронно, в потоці: уся пачка однією транзакцією; повертає (результат, виняток) на кожну op
+    results = []
+    with _conn_lock:
+        changes_before = db.total_changes
         try:
-            await db.execute("ALTER TABLE link_rules ADD COLUMN text_repl TEXT DEFAULT NULL")
-        except Exception:
-            pass
-        await db.commit()
+            # IMMEDIATE: блокування запису береться одразу, а не посеред пачки
+            db.execute("BEGIN IMMEDIATE")
+            for op in ops:
+                # savepoint на кожну операцію: якщо вона падає, відкочується лише вона,
+                # решта пачки комітиться
+                db.execute("SAVEPOINT write_op")
+                try:
+                    results.append((op(db), None))
+                except Exception as e:
+                    db.execute("ROLLBACK TO write_op")
+                    results.append((None, e))
+                db.execute("RELEASE write_op")
+            # нічого не змінилось (INSERT OR IGNORE дубліката, DELETE відсутнього) —
+            # закриваємо транзакцію без commit
+            db.execute("COMMIT" if db.total_changes != changes_before else "ROLLBACK")
+        except Exception as e:
+            if db.in_transaction:
+                try:
+                    db.execute("ROLLBACK")
+                except Exception:
+                    pass
+            results = [(None, e) for _ in ops]
+    return results
+
+async def _writer(db: sqlite3.Connection, q: asyncio.Queue):
+    while True:
+        batch = [await q.get()]
+        while len(batch) < _WRITE_BATCH_MAX and not q.empty():
+            batch.append(q.get_nowait())
+        results = await asyncio.to_thread(_apply_batch, db, [op for op, _ in batch])
+        for (_, fut), (result, exc) in zip(batch, results):
+            if not fut.done():
+                if exc is not None:
+                    fut.set_exception(exc)
+                else:
+                    fut.set_result(result)
+        for _ in batch:
+            q.task_done()
+
+async def flush():
+    # чекає, доки всі поставлені в чергу записи будуть закомічені (або відхилені)
+    if _write_q is not None:
+        await _write_q.join()
+
+async def _write(op: WriteOp) -> Any:
+    # ставимо операцію в чергу й чекаємо на commit її пачки; повертає результат op
+    await get_db()
+    fut = asyncio.get_running_loop().create_future()
+    await _write_q.put((op, fut))
+    return await fut
+
+
+_CHANNEL_KINDS = ("source", "destination")  # те саме, що CHECK у таблиці channels
+
 
 async def upsert_channel(tg_id: int, title: str, kind: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO channels (tg_id, title, kind) VALUES (?,?,?) "
-            "ON CONFLICT(tg_id) DO UPDATE SET title=excluded.title, kind=excluded.kind",
-            (tg_id, title, kind)
-        )
-        await db.commit()
-
-async def list_channels(kind: Optional[str] = None) -> List[Tuple[int,int,str,str]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        if kind:
-            q = await db.execute(
-                "SELECT id, tg_id, title, kind FROM channels WHERE kind=? ORDER BY id DESC",
-                (kind,)
-            )
-        else:
-            q = await db.execute("SELECT id, tg_id, title, kind FROM channels ORDER BY id DESC")
-        rows = await q.fetchall()
-        return rows
+    # перевіряємо до черги: помилка одразу, без проходу через писаря й SQLite
+    if kind not in _CHANNEL_KINDS:
+        raise ValueError(f"Невідомий тип каналу: {kind!r}")
+    await _write(lambda db: db.execute(
+        "INSERT INTO channels (tg_id, title, kind) VALUES (?,?,?) "
+        "ON CONFLICT(tg_id) DO UPDATE SET title=excluded.title, kind=excluded.kind",
+        (tg_id, title, kind)
+    ))
+
+# Два окремі запити, а не один `(?1 IS NULL OR kind=?1)`: з OR SQLite планує
+# повний SCAN і не використовує idx_channels_kind. Обидва рядки сталі, тож кожен
+# готується один раз і далі береться з кешу підготовлених запитів з'єднання.
+# Читаємо під _conn_lock між пачками писаря — лише закомічені дані.
+_LIST_CHANNELS_SQL = "SELECT id, tg_id, title, kind FROM channels ORDER BY id DESC"
+_LIST_CHANNELS_BY_KIND_SQL = "SELECT id, tg_id, title, kind FROM channels WHERE kind=? ORDER BY id DESC"
+
+def _fetch_channels(db: sqlite3.Connection, kind: Optional[str]) -> List[Channel]:
+    sql, params = (_LIST_CHANNELS_BY_KIND_SQL, (kind,)) if kind else (_LIST_CHANNELS_SQL, ())
+    with _conn_lock:
+        return [Channel._make(r) for r in db.execute(sql, params)]
+
+async def list_channels(kind: Optional[str] = None) -> List[Channel]:
+    db = await get_db()
+    return await asyncio.to_thread(_fetch_channels, db, kind)
+
+async def add_mappings_bulk(pairs: Iterable[Tuple[int, int]]):
+    # усі пари одним executemany в одній транзакції
+    pairs = list(pairs)
+    await _write(lambda db: db.executemany(
+        "INSERT OR IGNORE INTO mappings (source_tg_id, dest_tg_id) VALUES (?,?)",
+        pairs
+    ))
+    for source_tg_id, dest_tg_id in pairs:
+        dests = _mappings.get(source_tg_id, ())
+        if dest_tg_id not in dests:
+            _mappings[source_tg_id] = dests + (dest_tg_id,)
 
 async def add_mapping(source_tg_id: int, dest_tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO mappings (source_tg_id, dest_tg_id) VALUES (?,?)",
-            (source_tg_id, dest_tg_id)
-        )
-        await db.commit()
+    await add_mappings_bulk([(source_tg_id, dest_tg_id)])
 
 async def remove_mapping(source_tg_id: int, dest_tg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM mappings WHERE source_tg_id=? AND dest_tg_id=?",
-            (source_tg_id, dest_tg_id)
+    await _write(lambda db: db.execute(
+        "DELETE FROM mappings WHERE source_tg_id=? AND dest_tg_id=?",
+        (source_tg_id, dest_tg_id)
+    ))
+    dests = tuple(d for d in _mappings.get(source_tg_id, ()) if d != dest_tg_id)
+    if dests:
+        _mappings[source_tg_id] = dests
+    else:
+        _mappings.pop(source_tg_id, None)
+
+async def replace_mappings_for_source(source_tg_id: int, dest_ids: Iterable[int]):
+    # DELETE + вставка — одна операція писаря, тобто одна транзакція:
+    # читачі бачать або старий, або новий набір призначень
+    dests = tuple(dict.fromkeys(dest_ids))  # без дублікатів, порядок зберігається
+
+    def op(db: sqlite3.Connection):
+        db.execute("DELETE FROM mappings WHERE source_tg_id=?", (source_tg_id,))
+        db.executemany(
+            "INSERT OR IGNORE INTO mappings (source_tg_id, dest_tg_id) VALUES (?,?)",
+            [(source_tg_id, d) for d in dests]
         )
-        await db.commit()
 
-async def list_mappings_for_source(source_tg_id: int) -> List[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        q = await db.execute("SELECT dest_tg_id FROM mappings WHERE source_tg_id=?", (source_tg_id,))
-        rows = await q.fetchall()
-        return [r[0] for r in rows]
+    await _write(op)
+    if dests:
+        _mappings[source_tg_id] = dests
+    else:
+        _mappings.pop(source_tg_id, None)
+
+def is_mirrored_source(tg_id: int) -> bool:
+    # синхронна перевірка без await: у _mappings лишаються лише джерела з призначеннями
+    return tg_id in _mappings
+
+async def list_mappings_for_source(source_tg_id: int) -> Tuple[int, ...]:
+    # без звернення до БД і без копіювання — віддаємо кешований кортеж
+    return _mappings.get(source_tg_id, ())
+
+async def list_mappings_for_sources(source_tg_ids: Iterable[int]) -> Dict[int, Tuple[int, ...]]:
+    # кілька джерел за один виклик; джерела без призначень у результат не потрапляють
+    return {src: _mappings[src] for src in source_tg_ids if src in _mappings}
 
 # ------- ОНОВЛЕНО: правила з текстом -------
-async def add_link_rule(pattern: str, replacement: str, text_repl: Optional[str] = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+async def add_link_rules_bulk(rules: Iterable[Tuple[str, str, Optional[str]]]):
+    # rules: (pattern, replacement, text_repl)
+    global _link_rules, _compiled_rules, _rules_version
+    rules = list(rules)
+
+    def op(db: sqlite3.Connection):
+        db.executemany(
             "INSERT INTO link_rules (pattern, replacement, text_repl) VALUES (?,?,?)",
-            (pattern, replacement, text_repl)
+            rules
         )
-        await db.commit()
+        # писар один, AUTOINCREMENT монотонний — щойно вставлені рядки мають найбільші id
+        rows = db.execute(
+            "SELECT id, pattern, replacement, text_repl FROM link_rules ORDER BY id DESC LIMIT ?",
+            (len(rules),)
+        ).fetchall()
+        return [LinkRule._make(r) for r in reversed(rows)]
+
+    new_rows = await _write(op)
+    _link_rules = _link_rules + new_rows
+    _compiled_rules = None
+    _rules_version += 1
+
+async def add_link_rule(pattern: str, replacement: str, text_repl: Optional[str] = None):
+    await add_link_rules_bulk([(pattern, replacement, text_repl)])
 
 async def remove_link_rule(rule_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM link_rules WHERE id=?", (rule_id,))
-        await db.commit()
-
-async def list_link_rules():
-    async with aiosqlite.connect(DB_PATH) as db:
-        q = await db.execute(
-            "SELECT id, pattern, replacement, text_repl FROM link_rules ORDER BY id ASC"
+    global _link_rules, _compiled_rules, _rules_version
+    await _write(lambda db: db.execute("DELETE FROM link_rules WHERE id=?", (rule_id,)))
+    _link_rules = [r for r in _link_rules if r.id != rule_id]
+    _compiled_rules = None
+    _rules_version += 1
+
+async def list_link_rules() -> List[LinkRule]:
+    # без звернення до БД — див. _link_rules
+    return _link_rules
+
+async def get_compiled_rules() -> CompiledRules:
+    # для застосування на кожен пост: патерни компілюються один раз після зміни правил
+    global _compiled_rules
+    if _compiled_rules is None:
+        _compiled_rules = compile_rules(
+            [(r.pattern, r.replacement, r.text_repl) for r in _link_rules], _rules_version
         )
-        return await q.fetchall()
+    return _compiled_rules